@@ -2,13 +2,18 @@
 # -*- coding: utf-8 -*-
 """
 Évaluateur RPN pour « Un drôle de calcul druide ».
-Utilisation : python rpn_druide.py input.txt [--verbose]
+Utilisation : python programme_druide.py input.txt [--verbose]
+Fonctionne aussi sous PyPy : pypy3 programme_druide.py input.txt [--verbose]
 """
 
+import os
 import sys
-from typing import List, Tuple, Union
+from array import array
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Union
 import logging
-import operator
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import chain, islice
 
 # --- Exceptions spécifiques ---
 class RPNError(Exception):
@@ -29,84 +34,298 @@ handler = logging.StreamHandler()
 logger.addHandler(handler)
 logger.setLevel(logging.INFO)
 
-# --- Opérations ---
-OPS = {
-    '+': operator.add, '-': operator.sub,
-    '*': operator.mul, '/': operator.truediv
-}
+# --- Parallélisme ---
+PARALLEL_MIN_LINES = 10000
+CHUNK_LINES = 2048
 
-# --- Fonctions utilitaires ---
-def is_number(token: str) -> bool:
-    """Vérifie si le jeton est un nombre."""
+# --- Codes d'opération ---
+PUSH, ADD, SUB, MUL, DIV = range(5)
+OP_CODES = {'+': ADD, '-': SUB, '*': MUL, '/': DIV}
+OP_SYMBOLS = {code: sym for sym, code in OP_CODES.items()}
+# Code + IMMEDIATE : opération fusionnée avec l'empilement qui la précède.
+IMMEDIATE = DIV
+# Au-delà, générer le code source coûte plus que l'interprétation.
+SPECIALIZE_MAX_CODES = 64
+# Une forme n'est spécialisée qu'à partir de sa N-ième exécution.
+SPECIALIZE_AFTER = 8
+SHAPE_HITS_MAX = 4096
+
+# --- Types ---
+Program = Tuple[Tuple[int, ...], Tuple[float, ...]]
+Result = Tuple[int, Union[float, str]]
+Columns = Tuple[array, array, Dict[int, str]]
+
+# --- Compilation ---
+def parse_literals(literals: List[str]) -> Tuple[float, ...]:
+    """Convertit tous les littéraux d'une ligne en une seule passe."""
+    # Conversion groupée : `map` boucle en C sur tous les littéraux.
     try:
-        float(token)
-        return True
+        return tuple(map(float, literals))
     except ValueError:
-        return False
+        pass
+    # Chemin d'erreur seulement : retrouver le premier littéral invalide.
+    for token in literals:
+        try:
+            float(token)
+        except ValueError:
+            break
+    raise InvalidTokenError(f"Token '{token}' inconnu")
 
-# --- Évaluateur RPN ---
-def evaluate_rpn(tokens: List[str]) -> float:
-    """Évalue une liste de jetons RPN."""
-    stack: List[float] = []
+def orphan_position(tokens: List[str]) -> int:
+    """Position du premier opérateur sans ses deux opérandes."""
+    depth = 0
     for idx, token in enumerate(tokens):
         if not token:
             continue
-        if is_number(token):
-            num = float(token)
-            stack.append(num)
-            logger.debug("push %f", num)
-        elif token in OPS:
-            if len(stack) < 2:
-                msg = f"Opérateur '{token}' seul à la pos {idx}"
-                raise InsufficientOperandsError(msg)
-            val_b = stack.pop()
-            val_a = stack.pop()
-            if token == '/' and val_b == 0:
-                raise DivisionByZeroError("Zéro division")
-            res = OPS[token](val_a, val_b)
-            stack.append(res)
+        if token not in OP_CODES:
+            depth += 1
+        elif depth < 2:
+            return idx
+        else:
+            depth -= 1
+    return -1
+
+def compile_rpn(tokens: List[str]) -> Program:
+    """Traduit et valide les jetons : codes d'opération et opérandes."""
+    get_code = OP_CODES.get
+    op_push, immediate = PUSH, IMMEDIATE
+    codes: List[int] = []
+    literals: List[str] = []
+    add_code, add_literal = codes.append, literals.append
+    # Profondeur de pile simulée : la validité est prouvée avant l'exécution.
+    depth = 0
+    for token in tokens:
+        if not token:
+            continue
+        # Un seul lookup par jeton : il classe et donne le code à la fois.
+        code = get_code(token, op_push)
+        if code == op_push:
+            add_literal(token)
+            depth += 1
+        elif depth < 2:
+            parse_literals(literals)
+            idx = orphan_position(tokens)
+            msg = f"Opérateur '{token}' seul à la pos {idx}"
+            raise InsufficientOperandsError(msg)
         else:
-            raise InvalidTokenError(f"Token '{token}' inconnu")
-    if not stack:
+            depth -= 1
+            # Fusion « littéral puis opérateur » : une seule instruction.
+            if codes[-1] == op_push:
+                codes[-1] = code + immediate
+                continue
+        add_code(code)
+    vals = parse_literals(literals)
+    if not depth:
         raise RPNError("Pile vide")
-    if len(stack) > 1:
-        raise RPNError(f"Pile mal formée: {len(stack)} restants")
+    if depth > 1:
+        raise RPNError(f"Pile mal formée: {depth} restants")
+    return tuple(codes), vals
+
+def compile_line(line: str) -> Program:
+    """Compile une ligne de texte."""
+    # `str.split()` découpe en C : une regex `\S+` est ~7 fois plus lente.
+    return compile_rpn(line.split())
+
+# --- Évaluateur RPN ---
+def execute_rpn(codes: Tuple[int, ...], vals: Tuple[float, ...]) -> float:
+    """Exécute un programme validé par `compile_rpn`."""
+    # Liste volontairement : array('d') réemballe un float à chaque lecture,
+    # et un tampon préalloué avec indice coûte plus en bytecode que
+    # append/pop. `specialize_rpn` supprime les opérations de pile
+    # (ni append/pop, ni dispatch), mais ses locaux restent des float
+    # boxés.
+    stack: List[float] = []
+    # Liaisons locales : LOAD_FAST au lieu de LOAD_GLOBAL/LOAD_ATTR par jeton.
+    push, pop = stack.append, stack.pop
+    next_val = iter(vals).__next__
+    op_push, op_add, op_sub, op_mul = PUSH, ADD, SUB, MUL
+    immediate = IMMEDIATE
+    debug = logger.isEnabledFor(logging.DEBUG)
+    for code in codes:
+        if code == op_push:
+            num = next_val()
+            push(num)
+            if debug:
+                logger.debug("push %f depth=%d", num, len(stack))
+            continue
+        if code > immediate:
+            code -= immediate
+            val_b = next_val()
+            if debug:
+                # Opérande fusionné : il occupe virtuellement le sommet.
+                logger.debug("push %f depth=%d", val_b, len(stack) + 1)
+        else:
+            val_b = pop()
+        val_a = pop()
+        # Opérations en ligne : BINARY_OP, sans appel de fonction.
+        if code == op_add:
+            res = val_a + val_b
+        elif code == op_sub:
+            res = val_a - val_b
+        elif code == op_mul:
+            res = val_a * val_b
+        else:
+            # Pas de test du diviseur : Python lève déjà ZeroDivisionError,
+            # et un `try` ne coûte rien tant qu'il ne se déclenche pas.
+            try:
+                res = val_a / val_b
+            except ZeroDivisionError:
+                raise DivisionByZeroError("Zéro division") from None
+        push(res)
     return stack[0]
 
+@lru_cache(maxsize=4096)
+def specialize_rpn(codes: Tuple[int, ...]) -> Callable[..., float]:
+    """Génère une fonction en ligne droite pour une forme d'expression."""
+    # Une variable par niveau de pile, un paramètre par littéral.
+    body: List[str] = []
+    depth = n_vals = 0
+    for code in codes:
+        if code == PUSH:
+            body.append(f"s{depth} = v{n_vals}")
+            depth += 1
+            n_vals += 1
+            continue
+        if code > IMMEDIATE:
+            code -= IMMEDIATE
+            right = f"v{n_vals}"
+            n_vals += 1
+        else:
+            depth -= 1
+            right = f"s{depth}"
+        left = f"s{depth - 1}"
+        body.append(f"{left} = {left} {OP_SYMBOLS[code]} {right}")
+    params = ", ".join(f"v{i}" for i in range(n_vals))
+    source = (f"def specialized({params}):\n    "
+              + "\n    ".join(body) + "\n    return s0\n")
+    namespace: Dict[str, Callable[..., float]] = {}
+    exec(compile(source, "<rpn>", "exec"), namespace)
+    return namespace["specialized"]
+
+# Nombre d'exécutions par forme encore interprétée.
+shape_hits: Dict[Tuple[int, ...], int] = {}
+
+def run_rpn(codes: Tuple[int, ...], vals: Tuple[float, ...]) -> float:
+    """Exécute un programme, en version spécialisée quand c'est rentable."""
+    # En DEBUG, l'interpréteur reste le seul à tracer les empilements.
+    if logger.isEnabledFor(logging.DEBUG):
+        return execute_rpn(codes, vals)
+    if len(codes) <= SPECIALIZE_MAX_CODES:
+        # Une expression vue une seule fois ne rembourse pas `compile()`.
+        hits = shape_hits.get(codes, 0)
+        if hits >= SPECIALIZE_AFTER:
+            # Division par zéro : levée par Python, traduite une fois.
+            try:
+                return specialize_rpn(codes)(*vals)
+            except ZeroDivisionError:
+                raise DivisionByZeroError("Zéro division") from None
+        if len(shape_hits) >= SHAPE_HITS_MAX:
+            shape_hits.clear()
+        shape_hits[codes] = hits + 1
+    return execute_rpn(codes, vals)
+
+def evaluate_rpn(tokens: List[str]) -> float:
+    """Évalue une liste de jetons RPN."""
+    return run_rpn(*compile_rpn(tokens))
+
+@lru_cache(maxsize=4096)
+def evaluate_line(line: str) -> Union[float, str]:
+    """Évalue une ligne, en mémoire ; une erreur est rendue en message."""
+    # Le message est renvoyé, pas levé : lru_cache garde aussi les échecs.
+    try:
+        return run_rpn(*compile_line(line))
+    except RPNError as err:
+        return str(err)
+
 # --- Traitement ---
-def process_file(path: str, verbose: bool = False) -> List:
-    """Traite le fichier ligne par ligne."""
-    results = []
+def read_lines(path: str) -> Iterator[Tuple[int, str]]:
+    """Lit les lignes à évaluer, numérotées, sans vides ni commentaires."""
+    # Flux texte bufferisé : ni mmap (copie identique, échoue sur un
+    # fichier vide) ni un read() suivi de splitlines() ne sont plus rapides.
+    with open(path, 'r', encoding='utf-8', newline='') as file_ptr:
+        # `map` applique strip en C sur le flux de lignes déjà décodées.
+        for i, line in enumerate(map(str.strip, file_ptr), start=1):
+            if line and line[0] != '#':
+                yield i, line
+
+def evaluate_lines(lines: Iterable[Tuple[int, str]]) -> Iterator[Result]:
+    """Évalue des lignes numérotées au fil de l'eau, sans journalisation."""
+    for i, line in lines:
+        yield i, evaluate_line(line)
+
+def evaluate_parallel(lines: Iterable[Tuple[int, str]]) -> Iterator[Result]:
+    """Répartit les lignes sur plusieurs processus, ordre conservé."""
+    # Seul le texte voyage vers les processus, seules les valeurs en
+    # reviennent ; `chunksize` regroupe les envois.
+    numbers: List[int] = []
+    texts: List[str] = []
+    for i, line in lines:
+        numbers.append(i)
+        texts.append(line)
+    with ProcessPoolExecutor() as executor:
+        values = executor.map(evaluate_line, texts, chunksize=CHUNK_LINES)
+        yield from zip(numbers, values)
+
+def process_file(path: str, verbose: bool = False) -> Iterator[Result]:
+    """Traite le fichier ligne par ligne, en produisant chaque résultat."""
     if verbose:
         logger.setLevel(logging.DEBUG)
+    lines = read_lines(path)
     try:
-        with open(path, 'r', encoding='utf-8', newline='') as file_ptr:
-            for i, raw_line in enumerate(file_ptr, start=1):
-                line = raw_line.strip()
-                if not line or line.startswith('#'):
-                    continue
-                try:
-                    res = evaluate_rpn(line.split())
-                    results.append((i, res))
-                    logger.info("Ligne %d: %f", i, res)
-                except RPNError as err:
-                    logger.error("Ligne %d: %s", i, err)
-                    results.append((i, str(err)))
+        # Seules les premières lignes sont lues avant de choisir le mode.
+        head = list(islice(lines, PARALLEL_MIN_LINES))
     except (FileNotFoundError, PermissionError) as err:
         logger.error("Erreur fichier: %s", err)
         raise
-    return results
+    # Mémoire bornée au fichier courant.
+    evaluate_line.cache_clear()
+    shape_hits.clear()
+    # Sous le seuil, ou sur un seul cœur, les processus coûtent plus
+    # que le calcul. En DEBUG, la trace reste dans ce processus et dans
+    # l'ordre des lignes.
+    if (len(head) < PARALLEL_MIN_LINES or (os.cpu_count() or 1) < 2
+            or logger.isEnabledFor(logging.DEBUG)):
+        results = evaluate_lines(chain(head, lines))
+    else:
+        results = evaluate_parallel(chain(head, lines))
+    # Niveaux lus une fois : sans journal actif, aucun appel par ligne.
+    info_on = logger.isEnabledFor(logging.INFO)
+    error_on = logger.isEnabledFor(logging.ERROR)
+    for i, res in results:
+        if isinstance(res, str):
+            if error_on:
+                logger.error("Ligne %d: %s", i, res)
+        elif info_on:
+            logger.info("Ligne %d: %f", i, res)
+        yield i, res
+
+def process_file_columns(path: str, verbose: bool = False) -> Columns:
+    """Traite le fichier, résultats en colonnes : lignes, valeurs, erreurs."""
+    # Doubles et entiers contigus (16 octets par ligne) ; NaN sur erreur.
+    line_nums = array('q')
+    values = array('d')
+    errors: Dict[int, str] = {}
+    nan = float('nan')
+    for i, res in process_file(path, verbose):
+        line_nums.append(i)
+        if isinstance(res, str):
+            errors[i] = res
+            values.append(nan)
+        else:
+            values.append(res)
+    return line_nums, values, errors
 
 # --- Point d'entrée ---
 def main(args: List[str]) -> int:
     """Fonction principale."""
     if len(args) < 2:
-        print("Usage: python rpn_druide.py <file> [--verbose]")
+        print("Usage: python programme_druide.py <file> [--verbose]")
         return 1
     f_path = args[1]
     is_verbose = '--verbose' in args
     try:
-        process_file(f_path, is_verbose)
+        for _ in process_file(f_path, is_verbose):
+            pass
     except (OSError, UnicodeDecodeError):
         return 1
     return 0